@@ -1,4 +1,5 @@
 import os
+import uuid
 
 import chainlit as cl
 from dotenv import load_dotenv
@@ -8,14 +9,26 @@ from backend.agent import (
     run_financial_agent,
 )
 from backend.database import clear_thread_checkpoints
+from backend.semantic_cache import SemanticCache
 from backend.tools import (
     get_cached_companies,
 )
+from backend.trajectory_cache import TrajectoryCache
 
 load_dotenv()
 ENABLE_LOGGING = os.getenv("ENABLE_LOGGING", "true").lower() == "true"
 
+ENABLE_SEMANTIC_CACHE = os.getenv("ENABLE_SEMANTIC_CACHE", "true").lower() == "true"
+SEMANTIC_CACHE = SemanticCache() if ENABLE_SEMANTIC_CACHE else None
+ENABLE_TRAJECTORY_CACHE = os.getenv("ENABLE_TRAJECTORY_CACHE", "true").lower() == "true"
+TRAJECTORY_CACHE = TrajectoryCache() if ENABLE_TRAJECTORY_CACHE else None
+
+# Compiled once and shared by all sessions; threads are isolated by thread_id
+AGENT = create_financial_agent()
+
 print(f"Logging enabled: {ENABLE_LOGGING}")
+print(f"Semantic cache enabled: {ENABLE_SEMANTIC_CACHE}")
+print(f"Trajectory cache enabled: {ENABLE_TRAJECTORY_CACHE}")
 
 def load_users():
     """Load users from AUTH_USERS env variable"""
@@ -51,13 +64,10 @@ def auth_callback(username: str, password: str):
 @cl.on_chat_start
 async def start():
     """Initialize the agent when a new chat session starts."""
-    user = cl.user_session.get("user")
-
-    app = create_financial_agent()
-    thread_id = user.identifier
+    # A fresh thread per chat session, so concurrent tabs of one user never share checkpoints
+    thread_id = str(uuid.uuid4())
 
-    clear_thread_checkpoints(thread_id) 
-    cl.user_session.set("agent", app)
+    cl.user_session.set("agent", AGENT)
     cl.user_session.set("thread_id", thread_id)
 
     actions = [
@@ -91,42 +101,47 @@ async def main(message: cl.Message):
     msg = cl.Message(content="")
 
     await msg.send()
-    response, cost = run_financial_agent(
+    # The graph runs in a worker thread so the event loop can flush streamed tokens
+    response, cost = await cl.make_async(run_financial_agent)(
         app, 
         message.content, 
         thread_id=thread_id, 
-        enable_logging=ENABLE_LOGGING
+        enable_logging=ENABLE_LOGGING,
+        semantic_cache=SEMANTIC_CACHE,
+        trajectory_cache=TRAJECTORY_CACHE,
+        on_token=lambda token: cl.run_sync(msg.stream_token(token))
     )
 
-    # Update the message with the result
-    msg.content = response
-    await msg.update()
-    cached = get_cached_companies()
     if cost['tools_used']:
         tools_str = ', '.join([f"{tool}: {count}" for tool, count in cost['tools_used'].items()])
     else:
         tools_str = 'None'
 
-    cost_info = f"""
-            📊 **Usage Statistics:**
-            - Total Tokens: {cost['total_tokens']:,}
-            - Prompt Tokens: {cost['prompt_tokens']:,}
-            - Completion Tokens: {cost['completion_tokens']:,}
-            - Total Cost: ${cost['total_cost_usd']:.6f} USD
-            - LLM API Calls: {cost['llm_calls']}
-            - Tool Calls: {cost['tool_calls']}
-            - Cached Companies: {', '.join(cached) if cached else 'None'}
-            - Tools Used: {tools_str}
-            """
-    await cl.Message(
-        content=cost_info,
-        author="System"
-    ).send()
-
+    stats = [
+        "📊 **Usage Statistics:**",
+        f"- Total Tokens: {cost['total_tokens']:,}",
+        f"- Prompt Tokens: {cost['prompt_tokens']:,}",
+        f"- Completion Tokens: {cost['completion_tokens']:,}",
+        f"- Total Cost: ${cost['total_cost_usd']:.6f} USD",
+        f"- LLM API Calls: {cost['llm_calls']}",
+        f"- LLM Cache Hits: {cost.get('llm_cache_hits', 0)}",
+        f"- Tool Calls: {cost['tool_calls']}",
+        f"- Tools Used: {tools_str}",
+    ]
+    # Only repeat the cached company list when it changed since the last turn
+    cached = tuple(sorted(get_cached_companies()))
+    if cached != cl.user_session.get("last_cached_tuple"):
+        cl.user_session.set("last_cached_tuple", cached)
+        stats.append(f"- Cached Companies: {', '.join(cached) if cached else 'None'}")
+
+    # Answer and statistics go out in a single update instead of two messages
+    msg.content = response + "\n\n---\n" + "\n".join(stats)
+    await msg.update()
 
 @cl.on_chat_end
 async def end():
     """Clean up when chat session ends."""
+    clear_thread_checkpoints(cl.user_session.get("thread_id"))
     await cl.Message(
         content="👋 Thanks for using the Financial Analysis Assistant! Session ended.",
         author="System"
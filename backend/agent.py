@@ -1,31 +1,46 @@
 import os
 import sqlite3
 import sys
-from collections.abc import Sequence
+import uuid
+from collections.abc import Callable, Iterator, Sequence
+from contextlib import contextmanager
+from contextvars import ContextVar
 from pathlib import Path
 from typing import Annotated, TypedDict
 
 from dotenv import load_dotenv
+from langchain_community.cache import SQLiteCache
 from langchain_community.callbacks import get_openai_callback
+from langchain_community.callbacks.openai_info import OpenAICallbackHandler
+from langchain_core.globals import set_llm_cache
 from langchain_core.messages import (
+    AIMessage,
+    AIMessageChunk,
     BaseMessage,
     HumanMessage,
     SystemMessage,
+    ToolMessage,
     trim_messages,
 )
+from langchain_core.messages.utils import count_tokens_approximately
+from langchain_core.runnables.config import ContextThreadPoolExecutor
+from langchain_core.tracers.context import register_configure_hook
 from langchain_openai import ChatOpenAI
 from langgraph.checkpoint.sqlite import SqliteSaver
 from langgraph.graph import END, StateGraph
 from langgraph.graph.message import add_messages
 from langgraph.prebuilt import ToolNode
 
-from backend.database import Logger
+from backend.database import get_logger
 from backend.tools import (
+    LLM_MAX_RETRIES,
     correct_period_parameter,
     extract_stock_mentions,
     get_company_info,
     get_financial_statements,
+    get_full_report,
     get_stock_history,
+    get_stock_history_batch,
 )
 
 root_dir = Path(__file__).resolve().parent.parent
@@ -36,12 +51,76 @@ if str(root_dir) not in sys.path:
 
 load_dotenv()
 
+# Kept byte-identical across turns and threads so the provider's automatic
+# prefix cache can reuse it (OpenAI caches prompt prefixes >= 1024 tokens).
+SYSTEM_PROMPT = """You are a financial analysis assistant. Your role is to:
+- Analyze stock data and financial statements objectively
+- Provide clear, data-driven insights
+- Use available tools to gather accurate information
+- When comparing several tickers, fetch their price history in one get_stock_history_batch call
+- When you need a ticker's profile, recent prices and financials together, use get_full_report
+- Always cite your data sources"""
+
+# Tool order is part of the request prefix, so it is fixed at import time.
+TOOLS = [
+    get_company_info,
+    get_stock_history,
+    get_stock_history_batch,
+    get_financial_statements,
+    get_full_report,
+    correct_period_parameter,
+    extract_stock_mentions,
+]
+
+TOOLS_BY_NAME = {t.name: t for t in TOOLS}
+# Two tools sharing a name would silently shadow each other in routing and replay
+if len(TOOLS_BY_NAME) != len(TOOLS):
+    raise ValueError(f"Duplicate tool names registered: {[t.name for t in TOOLS]}")
+
+# ToolNode already runs the tool calls of one turn on a thread pool sized by the
+# run config's max_concurrency; cap it so a wide fan-out doesn't trip Yahoo's rate limit.
+MAX_TOOL_CONCURRENCY = 8
+
 # ============================================================================
 # STATE & GRAPH NODES
 # ============================================================================
+def count_per_turn(current: int, update: int | None) -> int:
+    """Reducer for running counters: add increments, reset to 0 when a turn starts with None."""
+    if update is None:
+        return 0
+    return (current or 0) + update
+
 class AgentState(TypedDict):
     """State object that flows through the graph."""
     messages: Annotated[Sequence[BaseMessage], add_messages]
+    # Maintained incrementally so routing never rescans the message history
+    llm_calls: Annotated[int, count_per_turn]
+    tool_call_count: Annotated[int, count_per_turn]
+
+def elide_stale_tool_outputs(messages: Sequence[BaseMessage], max_chars: int = 2000) -> list[BaseMessage]:
+    """
+    Replace large ToolMessages from earlier turns with a one-line note.
+    Tool results of the current turn (after the latest HumanMessage) are kept intact.
+    """
+    last_human = max(
+        (i for i, m in enumerate(messages) if isinstance(m, HumanMessage)),
+        default=-1
+    )
+    calls = {
+        call["id"]: call
+        for m in messages[:last_human]
+        for call in (getattr(m, "tool_calls", None) or [])
+    }
+
+    elided = []
+    for i, message in enumerate(messages):
+        if i < last_human and isinstance(message, ToolMessage) and len(str(message.content)) > max_chars:
+            call = calls.get(message.tool_call_id, {})
+            args = ", ".join(f"{k}={v}" for k, v in call.get("args", {}).items())
+            note = f"<tool result elided: {call.get('name', message.name)}({args}) from an earlier turn>"
+            message = message.model_copy(update={"content": note})
+        elided.append(message)
+    return elided
 
 def trim_message_history(messages: Sequence[BaseMessage], max_tokens: int = 160000) -> list[BaseMessage]:
     """
@@ -52,7 +131,7 @@ def trim_message_history(messages: Sequence[BaseMessage], max_tokens: int = 1600
         messages,
         max_tokens=max_tokens,
         strategy="last",           # keep the most recent messages
-        token_counter=ChatOpenAI(model="gpt-4o-mini"),
+        token_counter=count_tokens_approximately,  # no client or tokenizer load per step
         include_system=True,       # always keep the system prompt
         allow_partial=False,       # never cut a message in half
         start_on="human",          # ensure trimmed history starts on a human turn
@@ -62,43 +141,34 @@ def trim_message_history(messages: Sequence[BaseMessage], max_tokens: int = 1600
         print(f"⚠️  Trimmed {dropped} messages to stay under {max_tokens:,} token limit.")
     return trimmed
 
-def call_model(state: AgentState, model, tools):
-    """Call LLM with tool binding to decide next action."""
-    messages = state["messages"]
-    messages = trim_message_history(messages, max_tokens=40000)
-
-    try:
-        input_tokens = model.get_num_tokens_from_messages(messages)
-    except Exception:
-        input_tokens = "unknown"
+def call_model(state: AgentState, model_with_tools, system_prompt: str = SYSTEM_PROMPT):
+    """Call the tool-bound LLM (bound once in create_financial_agent) to decide next action."""
+    messages = elide_stale_tool_outputs(state["messages"])
+    messages = trim_message_history(messages, max_tokens=16000)
+    # The system prompt always sits at index 0 and is never stored in state
+    messages = [SystemMessage(content=system_prompt)] + [
+        m for m in messages if not isinstance(m, SystemMessage)
+    ]
 
+    input_tokens = count_tokens_approximately(messages)
     print(f"📨 Next call input: {len(messages)} messages, ~{input_tokens} tokens")
 
-    model_with_tools = model.bind_tools(tools)
     response = model_with_tools.invoke(messages)
-    return {"messages": [response]}
+    return {
+        "messages": [response],
+        "llm_calls": 1,
+        "tool_call_count": len(getattr(response, "tool_calls", None) or []),
+    }
 
 def should_continue(state: AgentState):
     """Route to tools, fallback, or end."""
-    messages = state["messages"]
-    last_message = messages[-1]
-
-    # Count total LLM responses (AIMessages) as a proxy for LLM calls
-    llm_calls = sum(
-        1 for m in messages
-        if hasattr(m, "type") and m.type == "ai"
-    )
+    last_message = state["messages"][-1]
 
-    if llm_calls >= 20:
+    if state.get("llm_calls", 0) >= 20:
         return "fallback"
 
     if hasattr(last_message, "tool_calls") and last_message.tool_calls:
-        total_tool_calls = sum(
-            len(m.tool_calls)
-            for m in messages
-            if hasattr(m, "tool_calls") and m.tool_calls
-        )
-        if total_tool_calls >= 50:
+        if state.get("tool_call_count", 0) >= 50:
             return "fallback"
         return "tools"
 
@@ -115,24 +185,53 @@ def fallback_response(state: AgentState):
 # ============================================================================
 # AGENT CREATION
 # ============================================================================
-def create_financial_agent():
+def enable_llm_cache():
+    """Cache LLM responses on disk so repeated temperature=0 prompts skip the API."""
+    cache_path = os.getenv("LLM_CACHE_DB_PATH", str(root_dir / "data" / "llm_cache.db"))
+    Path(cache_path).parent.mkdir(parents=True, exist_ok=True)
+    set_llm_cache(SQLiteCache(database_path=cache_path))
+
+class LLMCacheHitHandler(OpenAICallbackHandler):
+    """
+    Tally the usage of responses served from the LLM cache.
+    get_openai_callback still bills those as API calls; langchain marks them with total_cost == 0.
+    """
+    def on_llm_end(self, response, **kwargs):
+        if any(
+            (getattr(generation, "message", None) is not None
+             and (generation.message.usage_metadata or {}).get("total_cost") == 0)
+            for generations in response.generations for generation in generations
+        ):
+            super().on_llm_end(response, **kwargs)
+
+_llm_cache_hits_var: ContextVar[LLMCacheHitHandler | None] = ContextVar("llm_cache_hits", default=None)
+register_configure_hook(_llm_cache_hits_var, inheritable=True)
+
+@contextmanager
+def count_llm_cache_hits() -> Iterator[LLMCacheHitHandler]:
+    """Like get_openai_callback, but only counts LLM calls answered by the cache."""
+    handler = LLMCacheHitHandler()
+    _llm_cache_hits_var.set(handler)
+    yield handler
+    _llm_cache_hits_var.set(None)
+
+def create_financial_agent(system_prompt: str = SYSTEM_PROMPT):
     """Create financial analysis agent using LangGraph StateGraph."""
-    tools = [
-             get_company_info, 
-             get_stock_history, 
-             get_financial_statements, 
-             correct_period_parameter, 
-             extract_stock_mentions]
+    enable_llm_cache()
 
     model = ChatOpenAI(
         model="gpt-4o-mini",
         api_key=os.getenv("OPENAI_API_KEY"),
-        temperature=0
+        temperature=0,
+        stream_usage=True,  # keep token/cost accounting when responses are streamed
+        max_retries=LLM_MAX_RETRIES
     )
+    # Serialise the tool schemas once, not on every agent step
+    model_with_tools = model.bind_tools(TOOLS)
 
     workflow = StateGraph(AgentState)
-    workflow.add_node("agent", lambda state: call_model(state, model, tools))
-    workflow.add_node("tools", ToolNode(tools))
+    workflow.add_node("agent", lambda state: call_model(state, model_with_tools, system_prompt))
+    workflow.add_node("tools", ToolNode(TOOLS))
     workflow.add_node("fallback", fallback_response)  # ← new node
 
     workflow.set_entry_point("agent")
@@ -153,23 +252,118 @@ def create_financial_agent():
     # return workflow.compile()
 
 
-def run_financial_agent(app, user_query: str, thread_id: str = "default", enable_logging: bool = True):
-    """Execute agent and yield responses with cost breakdown."""
+def log_agent_run(user_query: str, response_content: str, metadata: dict):
+    """Queue one agent run for MotherDuck, warning instead of failing the request."""
+    try:
+        get_logger().log_agent_run(user_query, response_content, metadata)
+    except Exception as e:
+        print(f"⚠️  Warning: Failed to log to MotherDuck: {e}")
 
-    system_prompt = """You are a financial analysis assistant. Your role is to:
-                - Analyze stock data and financial statements objectively
-                - Provide clear, data-driven insights
-                - Use available tools to gather accurate information
-                - Always cite your data sources"""
+def lookup_semantic_cache(app, semantic_cache, user_query: str, config: dict):
+    """
+    Return (embedding, cached_result) for a query.
+    Only the first turn of a thread is cached, since follow-ups depend on earlier context.
+    """
+    if app.get_state(config).values.get("messages"):
+        return None, None
+    try:
+        embedding = semantic_cache.embed(user_query)
+        return embedding, semantic_cache.lookup(embedding, user_query)
+    except Exception as e:
+        print(f"⚠️  Warning: Semantic cache lookup failed: {e}")
+        return None, None
 
-    initial_messages = [
-        SystemMessage(content=system_prompt),
-        HumanMessage(content=user_query)
+def replay_trajectory(trajectory_cache, user_query: str) -> list[BaseMessage]:
+    """
+    Re-execute the recorded tool calls for a repeat query.
+    Returns an AIMessage + ToolMessages to seed the graph with, or [] on a miss.
+    """
+    tool_calls = trajectory_cache.get(user_query)
+    if not tool_calls or not trajectory_cache.is_reusable(user_query, tool_calls, TOOLS_BY_NAME):
+        return []
+
+    ai_message = AIMessage(content="", tool_calls=[
+        {"name": call["name"], "args": call["args"], "id": f"call_{uuid.uuid4().hex[:24]}"}
+        for call in tool_calls
+    ])
+    # Copies the caller's context into each worker so the OpenAI cost callback sees tool LLM calls
+    with ContextThreadPoolExecutor(max_workers=min(len(tool_calls), MAX_TOOL_CONCURRENCY)) as executor:
+        tool_messages = list(executor.map(
+            lambda call: TOOLS_BY_NAME[call["name"]].invoke({**call, "type": "tool_call"}),
+            ai_message.tool_calls
+        ))
+    print(f"♻️  Replayed {len(tool_calls)} cached tool call(s) for repeat query.")
+    return [ai_message] + tool_messages
+
+def extract_trajectory(messages: Sequence[BaseMessage]) -> list[dict]:
+    """Collect the tool calls made since the latest HumanMessage."""
+    turn = []
+    for message in reversed(messages):
+        if isinstance(message, HumanMessage):
+            break
+        turn.append(message)
+    return [
+        {"name": call["name"], "args": call["args"]}
+        for message in reversed(turn)
+        for call in (getattr(message, "tool_calls", None) or [])
     ]
-    config = {"configurable": {"thread_id": thread_id}}
 
-    with get_openai_callback() as cb:
-        result = app.invoke({"messages": initial_messages}, config=config)
+def stream_graph(app, graph_input: dict, config: dict, on_token: Callable[[str], None] | None = None) -> dict:
+    """
+    Run the graph, passing each LLM token from the agent node to on_token as it arrives.
+    Returns the final graph state, as app.invoke would.
+    """
+    result = None
+    for mode, data in app.stream(graph_input, config=config, stream_mode=["messages", "values"]):
+        if mode == "values":
+            result = data
+            continue
+        chunk, chunk_metadata = data
+        if (on_token is not None and chunk_metadata.get("langgraph_node") == "agent"
+                and isinstance(chunk, AIMessageChunk) and chunk.content):
+            on_token(chunk.content)
+    return result
+
+def run_financial_agent(app, user_query: str, thread_id: str, enable_logging: bool = True,
+                        semantic_cache=None, trajectory_cache=None, on_token: Callable[[str], None] | None = None):
+    """
+    Execute agent and return the response with cost breakdown.
+    If on_token is given, answer tokens are streamed to it while the graph runs.
+    """
+    initial_messages = [HumanMessage(content=user_query)]
+    config = {"configurable": {"thread_id": thread_id}, "max_concurrency": MAX_TOOL_CONCURRENCY}
+
+    embedding = None
+    if semantic_cache is not None:
+        embedding, cached = lookup_semantic_cache(app, semantic_cache, user_query, config)
+        if cached is not None:
+            response_content, metadata = cached
+            # Record the replayed turn so follow-up questions keep their context
+            app.update_state(
+                config,
+                {"messages": initial_messages + [AIMessage(content=response_content)]},
+                as_node="agent",
+            )
+            if enable_logging:
+                log_agent_run(user_query, response_content, metadata)
+            return response_content, metadata
+
+    with get_openai_callback() as cb, count_llm_cache_hits() as hits:
+        # Replayed tools may call the LLM themselves, so run them inside the cost callback
+        replayed = []
+        if trajectory_cache is not None:
+            try:
+                replayed = replay_trajectory(trajectory_cache, user_query)
+            except Exception as e:
+                print(f"⚠️  Warning: Trajectory replay failed: {e}")
+
+        # None resets the per-turn LLM and tool call counters
+        result = stream_graph(
+            app,
+            {"messages": initial_messages + replayed, "llm_calls": None, "tool_call_count": None},
+            config,
+            on_token
+        )
         tool_calls = 0
         tools_used = {}
 
@@ -184,28 +378,46 @@ def run_financial_agent(app, user_query: str, thread_id: str = "default", enable
             response_content = message.content
             # print(response_content)  # Print the response content for streaming
 
+        # Responses served from the LLM cache cost nothing, so take them out of the totals
         metadata = {
-            "total_tokens": cb.total_tokens,
-            "prompt_tokens": cb.prompt_tokens,
-            "completion_tokens": cb.completion_tokens,
-            "total_cost_usd": round(cb.total_cost, 6),
-            "successful_requests": cb.successful_requests,
-            "llm_calls": cb.successful_requests,
+            "total_tokens": cb.total_tokens - hits.total_tokens,
+            "prompt_tokens": cb.prompt_tokens - hits.prompt_tokens,
+            "completion_tokens": cb.completion_tokens - hits.completion_tokens,
+            "total_cost_usd": round(cb.total_cost - hits.total_cost, 6),
+            "successful_requests": cb.successful_requests - hits.successful_requests,
+            "llm_calls": cb.successful_requests - hits.successful_requests,
+            "llm_cache_hits": hits.successful_requests,
             "tool_calls": tool_calls,
             "tools_used": tools_used
         }
+        if replayed:
+            metadata["cache"] = "trajectory_hit"
+
+        # Fallback answers are not worth replaying
+        if embedding is not None and not isinstance(result["messages"][-1], SystemMessage):
+            semantic_cache.add(embedding, user_query, response_content, {
+                **metadata,
+                "total_tokens": 0,
+                "prompt_tokens": 0,
+                "completion_tokens": 0,
+                "total_cost_usd": 0.0,
+                "successful_requests": 0,
+                "llm_calls": 0,
+                "llm_cache_hits": 0,
+                "tool_calls": 0,
+                "tools_used": {},
+                "cache": "semantic_hit",
+            })
+
+        if trajectory_cache is not None and not replayed and not isinstance(result["messages"][-1], SystemMessage):
+            trajectory = extract_trajectory(result["messages"])
+            if trajectory:
+                trajectory_cache.put(user_query, trajectory)
 
         if enable_logging:
-            try:
-                logger = Logger(database_name="stock-assistant")
-                logger.connect()
-                logger.log_agent_run(user_query, response_content, metadata)
-                logger.close()
-            except Exception as e:
-                print(f"⚠️  Warning: Failed to log to MotherDuck: {e}")
+            log_agent_run(user_query, response_content, metadata)
         return response_content, metadata
 
-
 if __name__ == "__main__":
     pass
     # prompt = "Is MSFT still a buy"
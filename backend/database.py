@@ -1,12 +1,18 @@
-import json
+import atexit
+import functools
 import os
+import queue
 import sqlite3
+import threading
+import time
 from pathlib import Path
 
 import duckdb
 
 root_dir = Path(__file__).resolve().parent.parent
 
+_STOP = object()  # Sentinel telling the background writer to flush and exit
+
 
 class Logger:
     def __init__(self, database_name: str, token: str = None):
@@ -19,17 +25,24 @@ class Logger:
             self.database_name = database_name
             self.conn_str = f"md:{database_name}?motherduck_token={self.token}"
             self.conn = None
+            self._lock = threading.Lock()  # duckdb connections are not safe for concurrent writes
             self.max_length = 1000  # Max length for query and response to prevent oversized entries
+            self.batch_size = 50  # Max rows per INSERT from the background writer
+            self.flush_interval = 1.0  # Max seconds a row waits before being written
+            self._queue = queue.Queue()
+            self._worker = None
+            self._worker_lock = threading.Lock()  # separate from _lock so queueing never waits on the connection
         except Exception as e:
             raise RuntimeError(f"Failed to initialize Logger: {e}")
 
     def connect(self):
         """Establish connection to MotherDuck database."""
         try:
-            if not self.conn:
-                self.conn = duckdb.connect(self.conn_str)
-                self._ensure_table_exists()
-                print(f"✓ Connected to MotherDuck database: {self.database_name}")
+            with self._lock:
+                if not self.conn:
+                    self.conn = duckdb.connect(self.conn_str)
+                    self._ensure_table_exists()
+                    print(f"✓ Connected to MotherDuck database: {self.database_name}")
             return self
         except duckdb.ConnectionException as e:
             raise ConnectionError(f"Failed to connect to MotherDuck: {e}")
@@ -46,12 +59,25 @@ class Logger:
             total_tokens INTEGER,
             total_cost_usd DOUBLE,
             tool_calls INTEGER,
-            tools_used JSON,
+            tools_used MAP(VARCHAR, INTEGER),
             model_name VARCHAR DEFAULT 'gpt-4o-mini'
         )
         """
         try:
             self.conn.execute(create_query)
+            # Tables created before tools_used became a native MAP still store it as JSON
+            column_type = self.conn.execute("""
+                SELECT data_type FROM information_schema.columns
+                WHERE table_name = 'agent_logs' AND column_name = 'tools_used'
+            """).fetchone()
+            if column_type and column_type[0] == "JSON":
+                # Old rows hold '[]' when no tools ran, which cannot be cast to a MAP
+                self.conn.execute("""
+                    ALTER TABLE agent_logs ALTER tools_used TYPE MAP(VARCHAR, INTEGER)
+                    USING CASE WHEN json_type(tools_used) = 'OBJECT'
+                        THEN CAST(tools_used AS MAP(VARCHAR, INTEGER)) ELSE MAP {} END
+                """)
+                print("✓ Migrated agent_logs.tools_used from JSON to MAP(VARCHAR, INTEGER)")
             print("✓ Table 'agent_runs' is ready")
         except Exception as e:
             raise RuntimeError(f"Unexpected error creating table: {e}")
@@ -67,12 +93,9 @@ class Logger:
         return text[:max_length - 3] + "..."
 
     def log_agent_run(self, query: str, response: str, metadata: dict):
-        """Inserts agent execution data into MotherDuck."""
-        if not self.conn:
-            self.connect()
-
-        # Convert tools list to JSON string for storage
-        tools_json = json.dumps(metadata.get("tools_used", []))
+        """Queues agent execution data for a batched background insert into MotherDuck."""
+        # Bound as-is: duckdb maps a {tool_name: count} dict onto the MAP column
+        tools_used = metadata.get("tools_used") or {}
 
         # Truncate query and response
         truncated_query = self._truncate_text(query)
@@ -83,23 +106,77 @@ class Logger:
             print(f"ℹ️  Query truncated from {len(query)} to {self.max_length} characters")
         if len(response) > self.max_length:
             print(f"ℹ️  Response truncated from {len(response)} to {self.max_length} characters")
-        insert_query = """
-        INSERT INTO agent_logs (query, response, total_tokens, total_cost_usd, tool_calls, tools_used)
-        VALUES (?, ?, ?, ?, ?, ?)
-        """
-        self.conn.execute(insert_query, (
+
+        self._start_worker()
+        self._queue.put_nowait((
             truncated_query,
             truncated_response,
             metadata['total_tokens'],
             metadata['total_cost_usd'],
             metadata['tool_calls'],
-            tools_json
+            tools_used
         ))
-        print("Successfully logged run to MotherDuck.")
+
+    def _start_worker(self):
+        """Start the daemon thread that drains the queue, if not already running."""
+        with self._worker_lock:
+            if self._worker is None or not self._worker.is_alive():
+                self._worker = threading.Thread(target=self._run_worker, name="motherduck-logger", daemon=True)
+                self._worker.start()
+
+    def _run_worker(self):
+        """Collect up to batch_size rows or flush_interval seconds, then insert them together."""
+        stopping = False
+        while not stopping:
+            row = self._queue.get()
+            if row is _STOP:
+                break
+            rows = [row]
+            deadline = time.monotonic() + self.flush_interval
+            while len(rows) < self.batch_size:
+                try:
+                    row = self._queue.get(timeout=max(0.0, deadline - time.monotonic()))
+                except queue.Empty:
+                    break
+                if row is _STOP:
+                    stopping = True
+                    break
+                rows.append(row)
+            self._write_rows(rows)
+
+    def _write_rows(self, rows: list[tuple]):
+        insert_query = """
+        INSERT INTO agent_logs (query, response, total_tokens, total_cost_usd, tool_calls, tools_used)
+        VALUES (?, ?, ?, ?, ?, ?)
+        """
+        try:
+            if not self.conn:
+                self.connect()
+            with self._lock:
+                self.conn.executemany(insert_query, rows)
+            print(f"Successfully logged {len(rows)} run(s) to MotherDuck.")
+        except Exception as e:
+            print(f"⚠️  Warning: Failed to log to MotherDuck: {e}")
 
     def close(self):
-        if self.conn:
-            self.conn.close()
+        """Flush queued rows, stop the background writer and close the connection."""
+        if self._worker is not None and self._worker.is_alive():
+            self._queue.put(_STOP)
+            self._worker.join(timeout=10)
+        with self._lock:
+            if self.conn:
+                self.conn.close()
+                self.conn = None
+
+@functools.lru_cache(maxsize=1)
+def get_logger(database_name: str = "stock-assistant") -> Logger:
+    """
+    Return a process-wide Logger whose MotherDuck connection stays open until exit.
+    The connection is opened lazily by the background writer, off the request path.
+    """
+    logger = Logger(database_name=database_name)
+    atexit.register(logger.close)
+    return logger
 
 
 def clear_thread_checkpoints(thread_id: str):
@@ -121,5 +198,12 @@ def clear_thread_checkpoints(thread_id: str):
         return
 
     cursor.execute("DELETE FROM checkpoints WHERE thread_id = ?", (thread_id,))
+    # Pending writes belong to the same thread; drop them too so the file doesn't grow per session
+    cursor.execute("""
+        SELECT name FROM sqlite_master 
+        WHERE type='table' AND name='writes'
+    """)
+    if cursor.fetchone() is not None:
+        cursor.execute("DELETE FROM writes WHERE thread_id = ?", (thread_id,))
     conn.commit()
     conn.close()
@@ -0,0 +1,105 @@
+import atexit
+import json
+import os
+import re
+import threading
+import time
+from pathlib import Path
+
+import numpy as np
+from langchain_openai import OpenAIEmbeddings
+
+from backend.tools import PRICE_CACHE_TTL
+
+root_dir = Path(__file__).resolve().parent.parent
+
+# Ticker-like tokens (AAPL, BRK.B); "I" and "A" are far more often English words than tickers
+_TICKER_TOKEN_RE = re.compile(r"\b[A-Z]{1,5}(?:\.[A-Z]{1,3})?\b")
+_NON_TICKERS = frozenset({"I", "A"})
+
+
+class SemanticCache:
+    '''Replay answers for near-duplicate queries using embedding similarity.'''
+    def __init__(self, threshold: float = 0.95, ttl: int = PRICE_CACHE_TTL, max_entries: int = 1000,
+                 path: str = None, embeddings=None):
+        self.threshold = threshold
+        self.ttl = ttl  # Seconds before a cached answer is considered stale (prices move)
+        self.max_entries = max_entries
+        self.path = Path(path or os.getenv("SEMANTIC_CACHE_PATH", str(root_dir / "data" / "semantic_cache")))
+        self.embeddings = embeddings or OpenAIEmbeddings(
+            model="text-embedding-3-small",
+            api_key=os.getenv("OPENAI_API_KEY")
+        )
+        self._vectors = None   # (n, dim) matrix of unit-normalised query embeddings
+        self._entries = []     # aligned list of {"created_at", "query", "response", "metadata"}
+        self._lock = threading.Lock()
+        self._load()
+        atexit.register(self.save)
+
+    def embed(self, query: str) -> np.ndarray:
+        """Embed a query and normalise it so a dot product is the cosine similarity."""
+        vector = np.asarray(self.embeddings.embed_query(query.strip()), dtype=np.float32)
+        return vector / np.linalg.norm(vector)
+
+    @staticmethod
+    def tickers(query: str) -> frozenset:
+        """Ticker-like tokens in a query; a cached answer is only valid for the same set."""
+        return frozenset(_TICKER_TOKEN_RE.findall(query)) - _NON_TICKERS
+
+    def lookup(self, embedding: np.ndarray, query: str):
+        """
+        Return the cached (response, metadata) of the nearest fresh query about the same tickers, or None.
+        Similarity alone would let "P/E of GOOGL?" replay the answer for "P/E of GOOG?".
+        """
+        tickers = self.tickers(query)
+        with self._lock:
+            if not self._entries:
+                return None
+            scores = self._vectors @ embedding
+            for index in np.argsort(scores)[::-1]:
+                if scores[index] < self.threshold:
+                    return None
+                entry = self._entries[index]
+                if time.time() - entry["created_at"] > self.ttl:
+                    continue
+                # Entries saved before queries were stored can't be checked, so never match
+                if "query" not in entry or self.tickers(entry["query"]) != tickers:
+                    continue
+                return entry["response"], dict(entry["metadata"], similarity=round(float(scores[index]), 4))
+            return None
+
+    def add(self, embedding: np.ndarray, query: str, response: str, metadata: dict):
+        """Store a response under its query embedding, evicting the oldest entry when full."""
+        with self._lock:
+            vector = embedding.reshape(1, -1)
+            self._vectors = vector if self._vectors is None else np.vstack([self._vectors, vector])
+            self._entries.append({"created_at": time.time(), "query": query, "response": response, "metadata": metadata})
+            if len(self._entries) > self.max_entries:
+                self._vectors = self._vectors[1:]
+                self._entries = self._entries[1:]
+
+    def save(self):
+        """Persist the cache as an .npy matrix plus a JSON sidecar."""
+        with self._lock:
+            if not self._entries:
+                return
+            try:
+                self.path.parent.mkdir(parents=True, exist_ok=True)
+                np.save(self.path.with_suffix(".npy"), self._vectors)
+                self.path.with_suffix(".json").write_text(json.dumps(self._entries))
+            except Exception as e:
+                print(f"⚠️  Warning: Failed to save semantic cache: {e}")
+
+    def _load(self):
+        vectors_path = self.path.with_suffix(".npy")
+        entries_path = self.path.with_suffix(".json")
+        if not (vectors_path.exists() and entries_path.exists()):
+            return
+        try:
+            vectors = np.load(vectors_path)
+            entries = json.loads(entries_path.read_text())
+        except Exception as e:
+            print(f"⚠️  Warning: Failed to load semantic cache: {e}")
+            return
+        if len(vectors) == len(entries):
+            self._vectors, self._entries = vectors, entries
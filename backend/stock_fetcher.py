@@ -1,28 +1,84 @@
 
+from threading import RLock
+
 import pandas as pd
 import requests
 import yfinance as yf
+from cachetools import TTLCache, cached
 
 # CACHE_DIR = Path(os.environ.get("YF_CACHE_DIR", "/app/data/yf_cache"))
 # CACHE_DIR.mkdir(parents=True, exist_ok=True)
 # yf.set_tz_cache_location(str(CACHE_DIR))
 
+# Valid yfinance periods with a fixed length, in trading days (a week of trading is 5d)
+PERIOD_DAYS = {
+    "1d": 1, "5d": 5, "1mo": 21, "3mo": 63, "6mo": 126,
+    "1y": 252, "2y": 504, "5y": 1260, "10y": 2520,
+}
+
+# Trading days spanned by one bar of each daily-or-longer interval
+INTERVAL_DAYS = {"1d": 1, "5d": 5, "1wk": 5, "1mo": 21, "3mo": 63}
+
+def _covering_period(period: str, interval: str, bars: int) -> str:
+    """
+    Smallest fixed period holding at least `bars` bars of `interval`, never longer than `period`.
+    Falls back to `period` for ytd/max and intraday intervals, whose bar counts aren't fixed.
+    """
+    if period not in PERIOD_DAYS or interval not in INTERVAL_DAYS:
+        return period
+    # ~10% slack for market holidays, which PERIOD_DAYS doesn't account for
+    needed = bars * INTERVAL_DAYS[interval] * 1.1
+    for candidate, days in sorted(PERIOD_DAYS.items(), key=lambda item: item[1]):
+        if days >= min(needed, PERIOD_DAYS[period]):
+            return candidate
+    return period
+
+# Company name -> Yahoo search quotes; listings rarely change within a day
+_symbol_search_cache = TTLCache(maxsize=2048, ttl=86400)
+_search_session = requests.Session()  # keep-alive across searches
+
+@cached(_symbol_search_cache, key=lambda company_name: company_name.lower().strip(), lock=RLock())
+def _search_yahoo(company_name: str) -> list:
+    """Return Yahoo Finance search quotes for a query. Errors raise, so they are never cached."""
+    url = "https://query2.finance.yahoo.com/v1/finance/search"
+    params = {
+        "q": company_name,
+        "quotesCount": 5,
+        "newsCount": 0,
+    }
+
+    response = _search_session.get(
+        url, 
+        params=params, 
+        headers={'User-Agent': 'Mozilla/5.0'},
+        timeout=10
+    )
+    # A throttled or failed search must raise rather than cache an empty result
+    response.raise_for_status()
+    data = response.json()
+    return data.get('quotes') or []
+
 class CompanyData:
     '''Use yfinance to fetch financial data for a given ticker symbol.'''
     def __init__(self, ticker_symbol: str):
         self.ticker_symbol = ticker_symbol
         self.company = yf.Ticker(ticker_symbol)
-        self.session = None
+        self.session = None  # yfinance shares one curl_cffi session across all Tickers
 
-    def safe_get(self, ticker_symbol:str, attr_name:str, max_retries=3):
-        """Generic wrapper to fetch any yfinance attribute safely."""
+    def safe_get(self, ticker_symbol:str, attr_name:str, max_retries=3, **kwargs):
+        """
+        Generic wrapper to fetch any yfinance attribute safely.
+        Methods such as 'history' are called with **kwargs.
+        """
         ticker = yf.Ticker(ticker_symbol, session=self.session)
 
 
         for _ in range(max_retries):
             try:
                 data = getattr(ticker, attr_name)
-                if data is None or (isinstance(data, dict) and not data):
+                if callable(data):
+                    data = data(**kwargs)
+                if data is None or (isinstance(data, (dict, pd.DataFrame)) and len(data) == 0):
                     raise ValueError("Empty response from Yahoo")
                 return data
             except Exception as e: # 2000 requests per hour limit, or 48,000 requests per day limit
@@ -43,23 +99,57 @@ class CompanyData:
         info = self.safe_get(self.ticker_symbol, 'info', max_retries=3)
         return pd.DataFrame.from_dict(info, orient='index', columns=['Value'])
 
-    def get_ticker_data(self, period="1mo", interval="1d"):
+    def get_ticker_data(self, period="1mo", interval="1d", limit: int | None = None):
         """
         Returns a DataFrame of daily price data (OHLCV).
         :param period: 1d, 5d, 1mo, 3mo, 6mo, 1y, 2y, 5y, 10y, ytd, max
         :param interval: 1m, 2m, 5m, 15m, 30m, 60m, 90m, 1h, 1d, 5d, 1wk, 1mo, 3mo
+        :param limit: only the last `limit` bars are needed, so request just enough history
         """
-        # We use safe_get to wrap the history call
-        data = self.safe_get(self.ticker_symbol, 'history', max_retries=3)
+        if limit:
+            period = _covering_period(period, interval, limit)
+
+        # A single history request, with safe_get's retry and error handling
+        data = self.safe_get(self.ticker_symbol, 'history', max_retries=3, period=period, interval=interval)
 
         if data is not None:
-            df = self.company.history(period=period, interval=interval)
-            return df
+            return data.tail(limit) if limit else data
 
-        else:
-            print(f"Failed to fetch daily data for {self.ticker_symbol}. or invalid period/interval.")
+        print(f"Failed to fetch daily data for {self.ticker_symbol}. or invalid period/interval.")
         return pd.DataFrame()
 
+    @staticmethod
+    def get_ticker_data_batch(tickers: list[str], period="1mo", interval="1d", limit: int | None = None) -> dict:
+        """
+        Returns {ticker: DataFrame} of OHLCV data for several tickers in one yf.download call.
+        Tickers that fail to download map to an empty DataFrame.
+        :param limit: only the last `limit` bars per ticker are needed, so request just enough history
+        """
+        tickers = [t.upper() for t in tickers]
+        if limit:
+            period = _covering_period(period, interval, limit)
+        try:
+            data = yf.download(
+                tickers,
+                period=period,
+                interval=interval,
+                group_by="ticker",
+                threads=True,
+                progress=False,
+            )
+        except Exception as e:
+            print(f"❌ Error batch fetching history for {', '.join(tickers)}: {e}")
+            data = pd.DataFrame()
+
+        frames = {}
+        for ticker in tickers:
+            if ticker in data.columns.get_level_values(0):
+                frame = data[ticker].dropna(how="all")
+                frames[ticker] = frame.tail(limit) if limit else frame
+            else:
+                frames[ticker] = pd.DataFrame()
+        return frames
+
     @staticmethod
     def search_stock_symbol(company_name: str) -> dict:
         """
@@ -67,23 +157,11 @@ class CompanyData:
         Returns:dict: {"found": bool, "symbol": str, "matches": list, "message": str}
         """
         try:
-            url = "https://query2.finance.yahoo.com/v1/finance/search"
-            params = {
-                "q": company_name,
-                "quotesCount": 5,
-                "newsCount": 0,
-            }
-
-            response = requests.get(
-                url, 
-                params=params, 
-                headers={'User-Agent': 'Mozilla/5.0'}
-            )
-            data = response.json()
+            quotes = _search_yahoo(company_name)
 
-            if 'quotes' in data and data['quotes']:
+            if quotes:
                 matches = []
-                for quote in data['quotes'][:5]:
+                for quote in quotes[:5]:
                     matches.append({
                         "symbol": quote.get('symbol', ''),
                         "name": quote.get('longname', quote.get('shortname', '')),
@@ -108,7 +186,7 @@ class CompanyData:
                 "message": f"No results found for '{company_name}'"
             }
 
-        except Exception as e:
+        except (requests.RequestException, ValueError, TypeError) as e:
             return {
                 "found": False,
                 "symbol": "",
@@ -1,38 +1,140 @@
+import functools
 import os
+import re
+from bisect import bisect_left
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from threading import RLock
+from typing import Literal
 
-import tiktoken
+import diskcache
+from cachetools import TTLCache, cached
 from langchain_core.messages import HumanMessage, SystemMessage
 from langchain_core.tools import tool
 from langchain_openai import ChatOpenAI
 from pydantic import BaseModel, Field
 
-from backend.stock_fetcher import CompanyData
+from backend.stock_fetcher import PERIOD_DAYS, CompanyData
+from backend.utils import get_encoding
 
 # ============================================================================
 # CACHE & UTILS
 # ============================================================================
-_company_cache = {}
+# Bounded and expiring so long-running sessions don't accumulate stale tickers
+_company_cache = TTLCache(maxsize=256, ttl=int(os.getenv("COMPANY_CACHE_TTL", "900")))
+_cache_lock = RLock()
 
 def get_company_client(ticker: str) -> CompanyData:
     """Get or create a cached CompanyData instance."""
     ticker = ticker.upper()
-    if ticker not in _company_cache:
-        _company_cache[ticker] = CompanyData(ticker)
-    return _company_cache[ticker]
+    with _cache_lock:
+        client = _company_cache.get(ticker)
+        if client is None:
+            client = _company_cache[ticker] = CompanyData(ticker)
+        return client
+
+# Fetched yfinance frames survive restarts, so cold starts read disk instead of hitting Yahoo
+root_dir = Path(__file__).resolve().parent.parent
+_disk_cache = diskcache.Cache(
+    os.getenv("TOOL_CACHE_DIR", str(root_dir / "data" / "tool_cache")),
+    size_limit=500_000_000
+)
+FINANCIALS_CACHE_TTL = 86400  # annual statements change at most daily
+PRICE_CACHE_TTL = 900         # info (current price, market cap) and history go stale within minutes
+
+def _disk_cached(key: str, ttl: int, fetch):
+    """Return fetch() memoised on disk under key; empty or failed results are not stored."""
+    value = _disk_cache.get(key)
+    if value is None:
+        value = fetch()
+        if value is not None and not value.empty:
+            _disk_cache.set(key, value, expire=ttl)
+    return value
 
 def get_cached_companies():
     """Return list of currently cached company tickers."""
-    return list(_company_cache.keys())
+    with _cache_lock:
+        return list(_company_cache.keys())
+
+# Every tool result is re-sent on each later agent step, so keep it to ~4 KB
+MAX_TOOL_OUTPUT_TOKENS = 1000
+
+# The ~150-key yfinance info dict is mostly noise; keep the fields analysis needs
+_INFO_KEYS = [
+    "longName", "sector", "industry", "country", "fullTimeEmployees", "currency",
+    "currentPrice", "previousClose", "fiftyTwoWeekLow", "fiftyTwoWeekHigh", "marketCap",
+    "enterpriseValue", "trailingPE", "forwardPE", "trailingEps", "forwardEps",
+    "priceToBook", "dividendYield", "beta", "totalRevenue", "revenueGrowth",
+    "earningsGrowth", "grossMargins", "operatingMargins", "profitMargins",
+    "returnOnEquity", "debtToEquity", "freeCashflow", "recommendationKey",
+    "targetMeanPrice", "longBusinessSummary",
+]
+
+# The OpenAI client retries rate limits, timeouts and 5xx with exponential backoff
+LLM_MAX_RETRIES = 3
+
+@functools.lru_cache(maxsize=8)
+def _get_llm(model: str = "gpt-4o-mini", temperature: float = 0) -> ChatOpenAI:
+    """Shared ChatOpenAI client per (model, temperature), keeping its HTTP pool warm."""
+    return ChatOpenAI(
+        model=model,
+        api_key=os.getenv("OPENAI_API_KEY"),
+        temperature=temperature,
+        max_retries=LLM_MAX_RETRIES
+    )
+
+# Periods yfinance accepts, and shorthand that maps directly onto one of them
+ValidPeriod = Literal['1d', '5d', '1mo', '3mo', '6mo', '1y', '2y', '5y', '10y', 'ytd', 'max']
+_PERIOD_MAPPING = {
+    '1w': '5d',
+    '2w': '1mo',
+    '3w': '1mo',
+    '4w': '1mo',
+    'week': '5d',
+    'month': '1mo',
+    'year': '1y',
+    '3m': '3mo',
+    '6m': '6mo',
+    '2y': '2y',
+    '5y': '5y',
+    '10y': '10y',
+}
+
+# "<n> <unit>" period strings, resolved without an LLM call
+_PERIOD_RE = re.compile(
+    r'^\s*(\d+)\s*(days?|d|weeks?|wks?|w|months?|mos?|m|years?|yrs?|y)\s*$', re.I
+)
+_UNIT_DAYS = {"d": 1, "w": 5, "m": 21, "y": 252}  # trading days per unit
+_PERIOD_BUCKETS = sorted((days, period) for period, days in PERIOD_DAYS.items())
+_BUCKET_DAYS = [days for days, _ in _PERIOD_BUCKETS]
+
+def _round_up_period(period: str) -> str | None:
+    """Map e.g. '10 days' or '7w' to the smallest valid period covering it, or None if unparseable."""
+    match = _PERIOD_RE.match(period)
+    if not match:
+        return None
+    days = int(match.group(1)) * _UNIT_DAYS[match.group(2)[0].lower()]
+    index = bisect_left(_BUCKET_DAYS, days)
+    return _PERIOD_BUCKETS[index][1] if index < len(_PERIOD_BUCKETS) else "max"
 
 def truncate_tool_output(text: str, max_tokens: int = 5000) -> str:
     """Truncate tool output to prevent exceeding LLM token limits (200k budget)."""
-    enc = tiktoken.encoding_for_model("gpt-4o-mini")
+    enc = get_encoding("gpt-4o-mini")
     tokens = enc.encode(text)
     if len(tokens) > max_tokens:
-        tokens = tokens[:max_tokens]
-        return enc.decode(tokens) + f"\n... [output truncated from {len(tokens)} to {max_tokens} tokens]"
+        return enc.decode(tokens[:max_tokens]) + f"\n... [output truncated from {len(tokens)} to {max_tokens} tokens]"
     return text
 
+@cached(TTLCache(maxsize=512, ttl=600), lock=RLock())
+def _info_string(ticker: str) -> str:
+    """Formatted company info per ticker, memoised so repeat calls skip yfinance and pandas."""
+    info = _disk_cached(f"info:{ticker}", PRICE_CACHE_TTL, lambda: get_company_client(ticker).get_info())
+    info = info.reindex([key for key in _INFO_KEYS if key in info.index])
+    # Raise rather than return, so an unknown ticker or failed fetch is never memoised
+    if info.empty:
+        raise ValueError(f"No company info for {ticker}")
+    return truncate_tool_output(info.to_csv(), max_tokens=MAX_TOOL_OUTPUT_TOKENS)
+
 
 # ============================================================================
 # TOOLS
@@ -40,9 +142,12 @@ def truncate_tool_output(text: str, max_tokens: int = 5000) -> str:
 @tool
 def get_company_info(ticker: str):
     """Fetch key company metrics like P/E ratio, Market Cap, and business summary."""
-    client = get_company_client(ticker)
-    result = client.get_info().to_string()
-    return truncate_tool_output(result, max_tokens=5000)
+    ticker = ticker.upper()
+    try:
+        return _info_string(ticker)
+    except (TypeError, ValueError):
+        # get_info() raises TypeError when yfinance returned nothing for the ticker
+        return f"No company info found for {ticker}."
 
 @tool
 def get_stock_history(ticker: str, period: str = "1mo", interval: str = "1d"):
@@ -55,16 +160,98 @@ def get_stock_history(ticker: str, period: str = "1mo", interval: str = "1d"):
     'month', 'year'), you MUST call correct_period_parameter first to get the valid equivalent,
     then pass the corrected value here.
     """
-    client = get_company_client(ticker)
-    result = client.get_ticker_data(period=period, interval=interval).tail(10).to_string()
-    return truncate_tool_output(result, max_tokens=5000)
+    ticker = ticker.upper()
+    data = _disk_cached(
+        f"history:{ticker}:{period}:{interval}", PRICE_CACHE_TTL,
+        lambda: get_company_client(ticker).get_ticker_data(period=period, interval=interval, limit=10)
+    )
+    result = data.round(2).to_csv()
+    return truncate_tool_output(result, max_tokens=MAX_TOOL_OUTPUT_TOKENS)
+
+@tool
+def get_stock_history_batch(tickers: list[str], period: str = "1mo", interval: str = "1d"):
+    """Fetch daily price history (OHLCV) for several tickers at once, e.g. for comparisons.
+
+    Prefer this over calling get_stock_history once per ticker.
+    The period must be a valid value (1d, 5d, 1mo, 3mo, 6mo, 1y, 2y, 5y, 10y, ytd, max);
+    call correct_period_parameter first if it is not.
+    """
+    # Shares get_stock_history's disk cache entries; only the missing tickers are downloaded
+    keys = {ticker.upper(): f"history:{ticker.upper()}:{period}:{interval}" for ticker in tickers}
+    frames = {ticker: _disk_cache.get(key) for ticker, key in keys.items()}
+    missing = [ticker for ticker, df in frames.items() if df is None]
+    if missing:
+        fetched = CompanyData.get_ticker_data_batch(missing, period=period, interval=interval, limit=10)
+        for ticker, df in fetched.items():
+            if not df.empty:
+                _disk_cache.set(keys[ticker], df, expire=PRICE_CACHE_TTL)
+        frames.update(fetched)
+
+    sections = []
+    for ticker, df in frames.items():
+        # Truncated per ticker so a wide comparison can't silently drop the last tickers
+        body = df.round(2).to_csv() if not df.empty else "No data found."
+        sections.append(f"=== {ticker} ===\n{truncate_tool_output(body, max_tokens=MAX_TOOL_OUTPUT_TOKENS)}")
+    return "\n\n".join(sections)
 
 @tool
 def get_financial_statements(ticker: str):
     """Fetch the annual income statement and financial metrics."""
-    client = get_company_client(ticker)
-    result = client.get_financials().to_string()
-    return truncate_tool_output(result, max_tokens=5000)
+    ticker = ticker.upper()
+    financials = _disk_cached(
+        f"financials:{ticker}", FINANCIALS_CACHE_TTL, lambda: get_company_client(ticker).get_financials()
+    )
+    # ETFs and failed fetches have no statements
+    if financials is None or financials.empty:
+        return f"No financial statements found for {ticker}."
+    result = financials.to_csv()
+    return truncate_tool_output(result, max_tokens=MAX_TOOL_OUTPUT_TOKENS)
+
+@tool
+def get_full_report(ticker: str):
+    """Fetch company info, the last 10 daily prices (1mo) and annual financials for one ticker.
+
+    Prefer this over calling get_company_info, get_stock_history and get_financial_statements
+    separately for the same ticker.
+    """
+    fetches = {
+        "Company info": get_company_info.func,
+        "Price history (1mo)": get_stock_history.func,
+        "Financial statements": get_financial_statements.func,
+    }
+
+    def run(fetch):
+        # One failed section must not discard the others or abort the agent run
+        try:
+            return fetch(ticker)
+        except Exception as e:
+            return f"No data available: {e}"
+
+    # The three yfinance requests are independent, so overlap their round trips
+    with ThreadPoolExecutor(max_workers=len(fetches)) as executor:
+        results = list(executor.map(run, fetches.values()))
+    return "\n\n".join(f"=== {title} ===\n{body}" for title, body in zip(fetches, results, strict=True))
+
+# Static prompt text, built once at import rather than on every tool call
+_PERIOD_CORRECTION_SYSTEM = SystemMessage(content="Map invalid period to nearest valid option.")
+_PERIOD_CORRECTION_PROMPT = """Given the invalid period '{invalid_period}'.
+        Map it to the nearest valid option, ALWAYS choosing one larger than the invalid value to ensure we get enough data."""
+_EXTRACTION_SYSTEM_PROMPT = (
+    "You are a financial entity extractor. Your job is to extract ONLY explicitly mentioned stock tickers and company names.\n\n"
+    "RULES:\n"
+    "- Ticker symbols are usually 1-5 uppercase letters (e.g. AAPL, TSLA, GOOGL)\n"
+    "- Do NOT extract common English words that happen to be uppercase (e.g. 'IT', 'AI', 'US')\n"
+    "- Do NOT infer tickers from company names — only extract what is literally written\n"
+    "- Include informal references if unambiguous (e.g. 'the EV maker Elon runs' → Tesla)\n"
+    "- Normalize company names to their official form (e.g. 'Meta' → 'Meta Platforms')\n"
+    "- If a ticker and company refer to the same entity, include both\n"
+    "- Return empty lists if nothing is explicitly mentioned"
+)
+
+class PeriodCorrection(BaseModel):
+    period: ValidPeriod = Field(
+        description="The nearest valid yfinance period that covers the requested one"
+    )
 
 @tool
 def correct_period_parameter(invalid_period: str) -> str:
@@ -74,54 +261,36 @@ def correct_period_parameter(invalid_period: str) -> str:
     Call this BEFORE get_stock_history whenever the requested period is not already a valid value.
     Returns the corrected valid period string.
     """
-    # Direct mapping for common cases
-    period_mapping = {
-        '1w': '5d',
-        '2w': '1mo',
-        '3w': '1mo',
-        '4w': '1mo',
-        'week': '5d',
-        'month': '1mo',
-        'year': '1y',
-        '3m': '3mo',
-        '6m': '6mo',
-        '2y': '2y',
-        '5y': '5y',
-        '10y': '10y',
-    }
-
     # check for direct mapping first
     period_lower = invalid_period.lower().strip()
-    if period_lower in period_mapping:
-        return period_mapping[period_lower]
-
-    # LLM fallback for edge cases
-    correction_llm = ChatOpenAI(
-        model="gpt-4o-mini",
-        api_key=os.getenv("OPENAI_API_KEY"),
-        temperature=0
-    )
+    mapped = _PERIOD_MAPPING.get(period_lower)
+    if mapped:
+        return mapped
 
-    correction_prompt = f"""Given the invalid period '{invalid_period}'.
-        Map it to the nearest valid option, ALWAYS choosing one larger than the invalid value to ensure we get enough data. Valid periods are: 1d, 5d, 1mo, 3mo, 6mo, 1y, 2y, 5y, 10y, ytd, max.
-        Always choose a period that is larger than the invalid input to ensure sufficient data is returned.
-        Return ONLY the corrected period value, nothing else."""
+    # Numeric "<n> <unit>" inputs round up to the next valid bucket
+    rounded = _round_up_period(period_lower)
+    if rounded:
+        return rounded
 
-    correction_response = correction_llm.invoke([
-        SystemMessage(content="Map invalid period to nearest valid option."),
-        HumanMessage(content=correction_prompt)
-    ])
+    # LLM fallback for edge cases
+    correction_llm = _get_llm("gpt-4o-mini", 0)
 
-    corrected = correction_response.content.strip()
+    correction_prompt = _PERIOD_CORRECTION_PROMPT.format(invalid_period=invalid_period)
 
-    # Validate the response is actually valid
-    valid_periods = ['1d', '5d', '1mo', '3mo', '6mo', '1y', '2y', '5y', '10y', 'ytd', 'max']
-    if corrected in valid_periods:
-        return corrected
+    # The schema constrains the answer to a valid period, so there is no free text to parse
+    try:
+        correction = correction_llm.with_structured_output(PeriodCorrection).invoke([
+            _PERIOD_CORRECTION_SYSTEM,
+            HumanMessage(content=correction_prompt)
+        ])
+        return correction.period
+    except ValueError:
+        # Default fallback
+        return '1mo'
 
-    # Default fallback
-    return '1mo'
 
+# Looks like a ticker on its own, e.g. AAPL or BRK.B
+_TICKER_RE = re.compile(r'[A-Z]{1,5}(\.[A-Z]{1,3})?')
 
 class StockMentions(BaseModel):
     symbols: list[str] = Field(description="Explicit ticker symbols found e.g. AAPL, TSLA")
@@ -133,30 +302,21 @@ def extract_stock_mentions(query: str) -> dict:
     Extract stock ticker symbols and company names from a user query,
     then search for their symbols. Returns structured data ready for further analysis.
     """
-    query = truncate_tool_output(query, max_tokens=1500)
-    model = ChatOpenAI(model="gpt-4o-mini", temperature=0)
-    structured_model = model.with_structured_output(StockMentions)
-
-    result: StockMentions = structured_model.invoke([
-        {
-            "role": "system",
-            "content": (
-                "You are a financial entity extractor. Your job is to extract ONLY explicitly mentioned stock tickers and company names.\n\n"
-                "RULES:\n"
-                "- Ticker symbols are usually 1-5 uppercase letters (e.g. AAPL, TSLA, GOOGL)\n"
-                "- Do NOT extract common English words that happen to be uppercase (e.g. 'IT', 'AI', 'US')\n"
-                "- Do NOT infer tickers from company names — only extract what is literally written\n"
-                "- Include informal references if unambiguous (e.g. 'the EV maker Elon runs' → Tesla)\n"
-                "- Normalize company names to their official form (e.g. 'Meta' → 'Meta Platforms')\n"
-                "- If a ticker and company refer to the same entity, include both\n"
-                "- Return empty lists if nothing is explicitly mentioned"
-            )
-        },
-        {
-            "role": "user",
-            "content": query
-        }
-    ])
+    # A bare ticker (often forwarded from an earlier tool result) needs no extraction call
+    stripped = query.strip()
+    if _TICKER_RE.fullmatch(stripped) or stripped.upper() in get_cached_companies():
+        result = StockMentions(symbols=[stripped.upper()], companies=[])
+    else:
+        query = truncate_tool_output(query, max_tokens=1500)
+        structured_model = _get_llm("gpt-4o-mini", 0).with_structured_output(StockMentions)
+
+        result: StockMentions = structured_model.invoke([
+            {"role": "system", "content": _EXTRACTION_SYSTEM_PROMPT},
+            {
+                "role": "user",
+                "content": query
+            }
+        ])
 
     resolved = []
 
@@ -168,14 +328,14 @@ def extract_stock_mentions(query: str) -> dict:
             "search_result": None
         })
 
-    # For company names, search for their ticker
-    for company in result.companies:
-        # Skip if we already have a ticker for this company
-        already_found = any(r["symbol"].upper() == company.upper() for r in resolved)
-        if already_found:
-            continue
+    # For company names, search for their ticker, skipping names already given as tickers.
+    # Yahoo's search takes one query per request, so run the lookups concurrently.
+    mentioned = {symbol.upper() for symbol in result.symbols}
+    companies = [company for company in result.companies if company.upper() not in mentioned][:20]
+    with ThreadPoolExecutor(max_workers=max(1, min(len(companies), 8))) as executor:
+        search_results = list(executor.map(CompanyData.search_stock_symbol, companies))
 
-        search_result = CompanyData.search_stock_symbol(company)
+    for company, search_result in zip(companies, search_results, strict=True):
         if search_result["found"]:
             resolved.append({
                 "symbol": search_result["symbol"],
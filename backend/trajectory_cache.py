@@ -0,0 +1,76 @@
+import hashlib
+import json
+import os
+import re
+import sqlite3
+import threading
+from pathlib import Path
+
+root_dir = Path(__file__).resolve().parent.parent
+
+
+class TrajectoryCache:
+    '''Remember which tool calls answered a query so repeats can skip the planning loop.'''
+    def __init__(self, db_path: str = None):
+        self.db_path = db_path or os.getenv("TRAJECTORY_DB_PATH", str(root_dir / "data" / "trajectories.db"))
+        Path(self.db_path).parent.mkdir(parents=True, exist_ok=True)
+        self.conn = sqlite3.connect(self.db_path, check_same_thread=False)
+        self._lock = threading.Lock()
+        self._ensure_table_exists()
+
+    def _ensure_table_exists(self):
+        """Creates the trajectory table keyed by the normalised query hash."""
+        with self._lock:
+            self.conn.execute("""
+                CREATE TABLE IF NOT EXISTS trajectories (
+                    query_hash TEXT PRIMARY KEY,
+                    query TEXT,
+                    tool_calls TEXT,
+                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                )
+            """)
+            self.conn.commit()
+
+    @staticmethod
+    def query_hash(query: str) -> str:
+        """Hash the query after lower-casing and collapsing whitespace."""
+        normalized = " ".join(query.lower().split())
+        return hashlib.sha256(normalized.encode()).hexdigest()
+
+    @staticmethod
+    def is_reusable(query: str, tool_calls: list[dict], tool_names) -> bool:
+        """
+        Check a recorded trajectory still fits the query.
+        Every tool must still exist and every ticker argument must appear literally
+        in the query, so context-dependent follow-ups ("what about its P/E?") never match.
+        """
+        words = {w.strip(".") for w in re.findall(r"[A-Za-z0-9.\-^=]+", query.upper())}
+        for call in tool_calls:
+            if call["name"] not in tool_names:
+                return False
+            tickers = call["args"].get("tickers") or [call["args"].get("ticker")]
+            if any(ticker and ticker.upper() not in words for ticker in tickers):
+                return False
+        return True
+
+    def get(self, query: str) -> list[dict] | None:
+        """Return the recorded tool calls [{"name", "args"}] for a query, or None."""
+        with self._lock:
+            row = self.conn.execute(
+                "SELECT tool_calls FROM trajectories WHERE query_hash = ?",
+                (self.query_hash(query),)
+            ).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def put(self, query: str, tool_calls: list[dict]):
+        """Record (or replace) the tool calls that answered a query."""
+        with self._lock:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO trajectories (query_hash, query, tool_calls) VALUES (?, ?, ?)",
+                (self.query_hash(query), query, json.dumps(tool_calls))
+            )
+            self.conn.commit()
+
+    def close(self):
+        if self.conn:
+            self.conn.close()
@@ -1,18 +1,33 @@
+import functools
+import hashlib
 import os
 
 import tiktoken
 from dotenv import load_dotenv
 from openai import OpenAI
 
+load_dotenv()
+
 
 def create_state_graph(app, save_path="financial_agent_graph.png"):
-    """Visualize the agent graph and save to file."""
+    """Visualize the agent graph and save to file, skipping the render if the graph is unchanged."""
     try:
+        graph = app.get_graph()
+        # The mermaid source is built locally; only the PNG render goes over the network
+        graph_hash = hashlib.sha256(graph.draw_mermaid().encode()).hexdigest()
+        hash_path = f"{save_path}.sha256"
+        if os.path.exists(save_path) and os.path.exists(hash_path):
+            with open(hash_path) as f:
+                if f.read().strip() == graph_hash:
+                    print(f"✓ Graph unchanged, keeping {save_path}")
+                    return
 
-        png_data = app.get_graph().draw_mermaid_png()
+        png_data = graph.draw_mermaid_png()
         # Save to file
         with open(save_path, "wb") as f:
             f.write(png_data)
+        with open(hash_path, "w") as f:
+            f.write(graph_hash)
         print(f"✓ Graph saved to {save_path}")
 
 
@@ -22,14 +37,18 @@ def create_state_graph(app, save_path="financial_agent_graph.png"):
         print("\nASCII representation:")
         print(app.get_graph().draw_ascii())
 
-def open_ai_key_test(model="gpt-4o-mini"):
-    load_dotenv()
+@functools.lru_cache(maxsize=1)
+def _client():
+    """Shared OpenAI client, built once the API key is known."""
     api_key = os.getenv("OPENAI_API_KEY")
 
     if not api_key:
         raise RuntimeError("OPENAI_API_KEY not found. Add it to your .env or export it in your shell.")
 
-    client = OpenAI(api_key=api_key)
+    return OpenAI(api_key=api_key)
+
+def open_ai_key_test(model="gpt-4o-mini"):
+    client = _client()
 
     try:
         response = client.chat.completions.create(
@@ -42,9 +61,13 @@ def open_ai_key_test(model="gpt-4o-mini"):
     except Exception as e:
         print(f"An error occurred: {e}")
 
+@functools.lru_cache(maxsize=8)
+def get_encoding(model):
+    """Look up the tiktoken encoding once per model instead of on every count."""
+    return tiktoken.encoding_for_model(model)
+
 def calculate_number_of_tokens(text, model="gpt-4"):
-    encoding = tiktoken.encoding_for_model(model)
-    return len(encoding.encode(text))
+    return len(get_encoding(model).encode(text))
 
 if __name__ == "__main__":
     text = "This is a test message to calculate the number of tokens."
@@ -6,6 +6,7 @@ from unittest.mock import MagicMock, patch
 import pandas as pd
 
 os.environ.setdefault("YF_CACHE_DIR", tempfile.mkdtemp())
+os.environ.setdefault("TOOL_CACHE_DIR", tempfile.mkdtemp())
 
 from backend.stock_fetcher import CompanyData
 
@@ -52,6 +53,89 @@ class TestCompanyData(unittest.TestCase):
         self.assertTrue(df.empty)
         self.assertIsInstance(df, pd.DataFrame)
 
+    @patch('yfinance.Ticker')
+    def test_get_ticker_data_fetches_history_once(self, mock_ticker_class):
+        """Test get_ticker_data makes a single history request with the given period/interval."""
+        history = pd.DataFrame({"Close": [101.0, 102.5]})
+        mock_ticker_class.return_value.history.return_value = history
+
+        df = self.company_data.get_ticker_data(period="5d", interval="1d")
+
+        mock_ticker_class.return_value.history.assert_called_once_with(period="5d", interval="1d")
+        self.assertTrue(df.equals(history))
+
+    @patch('yfinance.Ticker')
+    def test_get_ticker_data_limit_requests_covering_period(self, mock_ticker_class):
+        """Test a row limit shrinks the requested period and returns only the last rows."""
+        history = pd.DataFrame({"Close": [float(i) for i in range(21)]})
+        mock_ticker_class.return_value.history.return_value = history
+
+        df = self.company_data.get_ticker_data(period="1y", interval="1d", limit=10)
+
+        mock_ticker_class.return_value.history.assert_called_once_with(period="1mo", interval="1d")
+        self.assertEqual(df["Close"].tolist(), [float(i) for i in range(11, 21)])
+
+    @patch('yfinance.download')
+    def test_get_ticker_data_batch_splits_by_ticker(self, mock_download):
+        """Test get_ticker_data_batch splits one multi-ticker download per ticker."""
+        columns = pd.MultiIndex.from_product([["TSLA", "F"], ["Close", "Volume"]])
+        mock_download.return_value = pd.DataFrame([[250.0, 100, 12.0, 200]], columns=columns)
+
+        frames = CompanyData.get_ticker_data_batch(["tsla", "F", "GM"])
+
+        mock_download.assert_called_once()
+        # Same split/dividend-adjusted Close as Ticker.history, which get_stock_history uses
+        self.assertNotIn("auto_adjust", mock_download.call_args.kwargs)
+        self.assertEqual(frames["TSLA"].loc[0, "Close"], 250.0)
+        self.assertEqual(frames["F"].loc[0, "Close"], 12.0)
+        self.assertTrue(frames["GM"].empty)
+
+    @patch('yfinance.download')
+    def test_get_ticker_data_batch_limit_requests_covering_period(self, mock_download):
+        """Test a row limit shrinks the downloaded period and keeps only the last rows per ticker."""
+        columns = pd.MultiIndex.from_product([["TSLA"], ["Close"]])
+        mock_download.return_value = pd.DataFrame([[float(i)] for i in range(21)], columns=columns)
+
+        frames = CompanyData.get_ticker_data_batch(["TSLA"], period="1y", limit=10)
+
+        self.assertEqual(mock_download.call_args.kwargs["period"], "1mo")
+        self.assertEqual(frames["TSLA"]["Close"].tolist(), [float(i) for i in range(11, 21)])
+
+    def test_search_stock_symbol_caches_by_normalized_name(self):
+        """Test repeated searches for the same company only hit Yahoo once."""
+        from backend import stock_fetcher
+
+        mock_response = MagicMock()
+        mock_response.json.return_value = {"quotes": [{"symbol": "TSLA", "longname": "Tesla, Inc."}]}
+        stock_fetcher._symbol_search_cache.clear()
+
+        with patch.object(stock_fetcher._search_session, 'get', return_value=mock_response) as mock_get:
+            first = CompanyData.search_stock_symbol("Tesla")
+            second = CompanyData.search_stock_symbol("  tesla ")
+
+        mock_get.assert_called_once()
+        self.assertEqual(first["symbol"], "TSLA")
+        self.assertEqual(second, first)
+
+    def test_search_stock_symbol_does_not_cache_http_errors(self):
+        """Test a failed search reports not found and is retried on the next call."""
+        import requests
+
+        from backend import stock_fetcher
+
+        throttled = MagicMock()
+        throttled.raise_for_status.side_effect = requests.HTTPError("429 Too Many Requests")
+        stock_fetcher._symbol_search_cache.clear()
+
+        with patch.object(stock_fetcher._search_session, 'get', return_value=throttled) as mock_get:
+            first = CompanyData.search_stock_symbol("Tesla")
+            second = CompanyData.search_stock_symbol("Tesla")
+
+        self.assertFalse(first["found"])
+        self.assertIn("429", first["message"])
+        self.assertEqual(mock_get.call_count, 2)
+        self.assertEqual(second, first)
+
 class TestAgentFunctions(unittest.TestCase):
 
     def test_should_continue_returns_tools_when_tool_calls_present(self):
@@ -74,21 +158,36 @@ class TestAgentFunctions(unittest.TestCase):
         result = should_continue(state)
         self.assertEqual(result, "end")
 
+    def test_should_continue_returns_fallback_when_call_budget_spent(self):
+        """should_continue routes to 'fallback' from the running counters, without rescanning history."""
+        from backend.agent import should_continue
+
+        mock_message = MagicMock()
+        mock_message.tool_calls = [{"name": "get_stock_history", "args": {}}]
+
+        self.assertEqual(should_continue({"messages": [mock_message], "llm_calls": 20}), "fallback")
+        self.assertEqual(should_continue({"messages": [mock_message], "tool_call_count": 50}), "fallback")
+        self.assertEqual(should_continue({"messages": [mock_message], "llm_calls": 3, "tool_call_count": 5}), "tools")
+
+    def test_count_per_turn_accumulates_and_resets(self):
+        """The counter reducer adds increments and resets on None."""
+        from backend.agent import count_per_turn
+
+        self.assertEqual(count_per_turn(3, 2), 5)
+        self.assertEqual(count_per_turn(7, None), 0)
+
     def test_call_model_returns_message_in_state(self):
         """call_model invokes the model and wraps the response in a messages dict."""
         from langchain_core.messages import HumanMessage
 
         mock_response = MagicMock()
-        mock_model = MagicMock()
         mock_model_with_tools = MagicMock()
-        mock_model.bind_tools.return_value = mock_model_with_tools
         mock_model_with_tools.invoke.return_value = mock_response
 
         state = {"messages": [HumanMessage(content="Test message")]}
-        tools = []
 
         from backend.agent import call_model
-        result = call_model(state, mock_model, tools)
+        result = call_model(state, mock_model_with_tools)
 
         self.assertIn("messages", result)
         self.assertEqual(result["messages"], [mock_response])
@@ -100,22 +199,541 @@ class TestAgentFunctions(unittest.TestCase):
         from backend.agent import call_model
 
         mock_response = MagicMock()
-        mock_model = MagicMock()
         mock_model_with_tools = MagicMock()
-        mock_model.bind_tools.return_value = mock_model_with_tools
         mock_model_with_tools.invoke.return_value = mock_response
 
         state = {
             "messages": [HumanMessage(content="What is AAPL?")],
         }
-        tools = []
-        result = call_model(state, mock_model, tools)
+        result = call_model(state, mock_model_with_tools)
 
         self.assertIn("messages", result)
         self.assertEqual(result["messages"], [mock_response])
         # Verify that invoke was called with the messages from state
         mock_model_with_tools.invoke.assert_called_once()
 
+    def test_elide_stale_tool_outputs_keeps_current_turn(self):
+        """Large tool results from earlier turns are elided; the current turn is untouched."""
+        from langchain_core.messages import AIMessage, HumanMessage, ToolMessage
+
+        from backend.agent import elide_stale_tool_outputs
+
+        big_output = "row\n" * 1000
+        call = {"name": "get_stock_history", "args": {"ticker": "TSLA"}, "id": "call_1"}
+        messages = [
+            HumanMessage(content="How is TSLA doing?"),
+            AIMessage(content="", tool_calls=[call]),
+            ToolMessage(content=big_output, tool_call_id="call_1"),
+            AIMessage(content="TSLA is up."),
+            HumanMessage(content="And F?"),
+            AIMessage(content="", tool_calls=[{**call, "args": {"ticker": "F"}, "id": "call_2"}]),
+            ToolMessage(content=big_output, tool_call_id="call_2"),
+        ]
+
+        result = elide_stale_tool_outputs(messages)
+
+        self.assertEqual(result[2].content, "<tool result elided: get_stock_history(ticker=TSLA) from an earlier turn>")
+        self.assertEqual(result[2].tool_call_id, "call_1")
+        self.assertEqual(result[6].content, big_output)
+        self.assertEqual(messages[2].content, big_output)
+
+    def test_stream_graph_forwards_agent_tokens(self):
+        """stream_graph passes agent-node tokens to on_token and returns the final state."""
+        from langchain_core.language_models import GenericFakeChatModel
+        from langchain_core.messages import AIMessage, HumanMessage
+        from langgraph.graph import END, START, MessagesState, StateGraph
+
+        from backend.agent import stream_graph
+
+        model = GenericFakeChatModel(messages=iter([AIMessage(content="AAPL looks strong")]))
+        workflow = StateGraph(MessagesState)
+        workflow.add_node("agent", lambda state: {"messages": [model.invoke(state["messages"])]})
+        workflow.add_edge(START, "agent")
+        workflow.add_edge("agent", END)
+
+        tokens = []
+        result = stream_graph(
+            workflow.compile(),
+            {"messages": [HumanMessage(content="How is AAPL?")]},
+            config={},
+            on_token=tokens.append
+        )
+
+        self.assertEqual("".join(tokens), "AAPL looks strong")
+        self.assertGreater(len(tokens), 1)
+        self.assertEqual(result["messages"][-1].content, "AAPL looks strong")
+
+    def test_replay_trajectory_tools_see_cost_callback(self):
+        """Replayed tools run in the caller's context, so their LLM usage reaches get_openai_callback."""
+        from langchain_community.callbacks import get_openai_callback
+        from langchain_community.callbacks.manager import openai_callback_var
+        from langchain_core.tools import tool
+
+        from backend import agent
+
+        @tool
+        def probe(ticker: str) -> str:
+            """Report whether the cost callback is active."""
+            return str(openai_callback_var.get() is not None)
+
+        trajectory_cache = MagicMock()
+        trajectory_cache.get.return_value = [{"name": "probe", "args": {"ticker": "MSFT"}}]
+        with patch.dict(agent.TOOLS_BY_NAME, {"probe": probe}), get_openai_callback():
+            replayed = agent.replay_trajectory(trajectory_cache, "MSFT")
+
+        self.assertEqual(replayed[1].content, "True")
+
+    def test_count_llm_cache_hits_tallies_only_cached_responses(self):
+        """A response replayed from the LLM cache is counted as a hit; a fresh API call is not."""
+        from langchain_community.callbacks import get_openai_callback
+        from langchain_core.caches import InMemoryCache
+        from langchain_core.globals import get_llm_cache, set_llm_cache
+        from langchain_core.messages import AIMessage
+        from langchain_core.outputs import ChatGeneration, ChatResult
+        from langchain_openai import ChatOpenAI
+
+        from backend.agent import count_llm_cache_hits
+
+        def generate(self, messages, stop=None, run_manager=None, **kwargs):
+            message = AIMessage(content="hi", usage_metadata={"input_tokens": 1000, "output_tokens": 500, "total_tokens": 1500})
+            return ChatResult(generations=[ChatGeneration(message=message)], llm_output={"model_name": "gpt-4o-mini"})
+
+        previous_cache = get_llm_cache()
+        set_llm_cache(InMemoryCache())
+        self.addCleanup(set_llm_cache, previous_cache)
+        model = ChatOpenAI(model="gpt-4o-mini", api_key="sk-test", temperature=0)
+        with patch.object(ChatOpenAI, "_generate", generate):
+            with get_openai_callback() as cb, count_llm_cache_hits() as hits:
+                model.invoke("Is MSFT a buy?")
+            self.assertEqual((cb.successful_requests, hits.successful_requests), (1, 0))
+
+            with get_openai_callback() as cb, count_llm_cache_hits() as hits:
+                model.invoke("Is MSFT a buy?")
+            self.assertEqual((cb.successful_requests, hits.successful_requests), (1, 1))
+            self.assertEqual(cb.total_tokens - hits.total_tokens, 0)
+            self.assertAlmostEqual(cb.total_cost - hits.total_cost, 0.0)
+
+    def test_tool_node_runs_tool_calls_in_parallel(self):
+        """Independent tool calls in one turn overlap instead of running back-to-back."""
+        import time
+
+        from langchain_core.messages import AIMessage
+        from langchain_core.tools import tool
+        from langgraph.graph import END, START, MessagesState, StateGraph
+        from langgraph.prebuilt import ToolNode
+
+        from backend.agent import MAX_TOOL_CONCURRENCY
+
+        @tool
+        def slow_lookup(ticker: str) -> str:
+            """Pretend to fetch data over the network."""
+            time.sleep(0.3)
+            return ticker
+
+        workflow = StateGraph(MessagesState)
+        workflow.add_node("tools", ToolNode([slow_lookup]))
+        workflow.add_edge(START, "tools")
+        workflow.add_edge("tools", END)
+        graph = workflow.compile()
+
+        tool_calls = [{"name": "slow_lookup", "args": {"ticker": t}, "id": t} for t in ["AAPL", "MSFT", "NVDA"]]
+        start = time.monotonic()
+        result = graph.invoke(
+            {"messages": [AIMessage(content="", tool_calls=tool_calls)]},
+            config={"max_concurrency": MAX_TOOL_CONCURRENCY}
+        )
+        elapsed = time.monotonic() - start
+
+        self.assertEqual([m.content for m in result["messages"][1:]], ["AAPL", "MSFT", "NVDA"])
+        self.assertLess(elapsed, 0.8)
+
+    def test_agent_has_single_routing_branch(self):
+        """The agent node is routed by should_continue exactly once per step."""
+        from langchain_core.globals import set_llm_cache
+
+        from backend.agent import create_financial_agent
+
+        tmp_dir = tempfile.mkdtemp()
+        env = {
+            "OPENAI_API_KEY": "sk-test",
+            "CHECKPOINT_DB_PATH": os.path.join(tmp_dir, "checkpoints.db"),
+            "LLM_CACHE_DB_PATH": os.path.join(tmp_dir, "llm_cache.db"),
+        }
+        with patch.dict(os.environ, env):
+            app = create_financial_agent()
+        self.addCleanup(set_llm_cache, None)
+
+        self.assertEqual(list(app.builder.branches), ["agent"])
+        self.assertEqual(list(app.builder.branches["agent"]), ["should_continue"])
+
+
+class TestTools(unittest.TestCase):
+    def setUp(self):
+        """Point the tools' disk cache at a temporary directory."""
+        import diskcache
+
+        from backend import tools
+
+        self.disk_cache = diskcache.Cache(tempfile.mkdtemp())
+        patcher = patch.object(tools, "_disk_cache", self.disk_cache)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.addCleanup(self.disk_cache.close)
+
+    def test_truncate_tool_output_reuses_cached_encoding(self):
+        """The tokenizer is looked up once, not on every tool result."""
+        from backend import tools, utils
+
+        utils.get_encoding.cache_clear()
+        self.addCleanup(utils.get_encoding.cache_clear)
+        with patch.object(utils.tiktoken, "encoding_for_model") as mock_encoding_for_model:
+            mock_encoding_for_model.return_value.encode.side_effect = lambda text: text.split()
+            tools.truncate_tool_output("a b c", max_tokens=5)
+            tools.truncate_tool_output("d e", max_tokens=5)
+
+        mock_encoding_for_model.assert_called_once_with("gpt-4o-mini")
+
+    def test_get_company_info_memoizes_formatted_output(self):
+        """Repeat get_company_info calls reuse the formatted string instead of refetching."""
+        from backend import tools
+
+        info = pd.DataFrame({"Value": [3000000000, "abc-123"]}, index=["marketCap", "uuid"])
+        with patch.object(tools, "get_company_client") as mock_client, \
+                patch.object(tools, "truncate_tool_output", side_effect=lambda text, max_tokens: text):
+            mock_client.return_value.get_info.return_value = info
+            first = tools.get_company_info.invoke({"ticker": "zzzz"})
+            second = tools.get_company_info.invoke({"ticker": "ZZZZ"})
+
+        self.assertIn("marketCap", first)
+        self.assertNotIn("uuid", first)
+        self.assertEqual(first, second)
+        mock_client.assert_called_once_with("ZZZZ")
+
+    def test_get_company_info_reports_unknown_ticker_without_caching(self):
+        """A failed info fetch returns a message instead of raising, and is retried next time."""
+        from backend import tools
+
+        with patch.object(tools, "get_company_client") as mock_client, \
+                patch.object(tools, "truncate_tool_output", side_effect=lambda text, max_tokens: text):
+            mock_client.return_value.get_info.side_effect = TypeError("'NoneType' object is not iterable")
+            first = tools.get_company_info.invoke({"ticker": "nope"})
+            second = tools.get_company_info.invoke({"ticker": "NOPE"})
+
+        self.assertEqual(first, "No company info found for NOPE.")
+        self.assertEqual(second, first)
+        self.assertEqual(mock_client.return_value.get_info.call_count, 2)
+
+    def test_company_info_disk_cache_expires_with_prices(self):
+        """Company info carries the current price, so it is cached no longer than price history."""
+        import time
+
+        from backend import tools
+
+        info = pd.DataFrame({"Value": [123.45]}, index=["currentPrice"])
+        with patch.object(tools, "get_company_client") as mock_client, \
+                patch.object(tools, "truncate_tool_output", side_effect=lambda text, max_tokens: text):
+            mock_client.return_value.get_info.return_value = info
+            tools.get_company_info.invoke({"ticker": "xxxx"})
+
+        _, expire_time = self.disk_cache.get("info:XXXX", expire_time=True)
+        self.assertLessEqual(expire_time - time.time(), tools.PRICE_CACHE_TTL)
+
+    def test_get_stock_history_reads_disk_cache_and_skips_empty_results(self):
+        """History is served from the disk cache once fetched; empty frames are refetched."""
+        from backend import tools
+
+        history = pd.DataFrame({"Close": [101.5, 102.25]})
+        with patch.object(tools, "get_company_client") as mock_client, \
+                patch.object(tools, "truncate_tool_output", side_effect=lambda text, max_tokens: text):
+            mock_client.return_value.get_ticker_data.side_effect = [pd.DataFrame(), history]
+            tools.get_stock_history.invoke({"ticker": "zzzz", "period": "5d"})
+            tools.get_stock_history.invoke({"ticker": "ZZZZ", "period": "5d"})
+            result = tools.get_stock_history.invoke({"ticker": "ZZZZ", "period": "5d"})
+
+        self.assertEqual(mock_client.return_value.get_ticker_data.call_count, 2)
+        self.assertEqual(result, ",Close\n0,101.5\n1,102.25\n")
+        pd.testing.assert_frame_equal(self.disk_cache.get("history:ZZZZ:5d:1d"), history)
+
+    def test_get_full_report_runs_fetches_concurrently(self):
+        """get_full_report overlaps the info, history and financials fetches for one ticker."""
+        import threading
+
+        from backend import tools
+
+        barrier = threading.Barrier(3, timeout=5)
+
+        def fetch(label):
+            def run(*args, **kwargs):
+                barrier.wait()  # only passes if all three fetches are in flight at once
+                return pd.DataFrame({"Value": [label]})
+            return run
+
+        with patch.object(tools, "get_company_client") as mock_client, \
+                patch.object(tools, "truncate_tool_output", side_effect=lambda text, max_tokens: text):
+            mock_client.return_value.get_info.side_effect = fetch("info")
+            mock_client.return_value.get_ticker_data.side_effect = fetch("history")
+            mock_client.return_value.get_financials.side_effect = fetch("financials")
+            result = tools.get_full_report.invoke({"ticker": "yyyy"})
+
+        self.assertLess(result.index("Company info"), result.index("Price history"))
+        self.assertLess(result.index("Price history"), result.index("Financial statements"))
+        self.assertIn("financials", result)
+
+    def test_get_full_report_keeps_sections_when_one_fails(self):
+        """A failing or empty section is reported as missing instead of failing the whole report."""
+        from backend import tools
+
+        with patch.object(tools, "get_company_client") as mock_client, \
+                patch.object(tools, "truncate_tool_output", side_effect=lambda text, max_tokens: text):
+            mock_client.return_value.get_info.side_effect = RuntimeError("Yahoo unavailable")
+            mock_client.return_value.get_ticker_data.return_value = pd.DataFrame({"Close": [50.0]})
+            mock_client.return_value.get_financials.return_value = None
+            result = tools.get_full_report.invoke({"ticker": "wwww"})
+
+        self.assertIn("No data available: Yahoo unavailable", result)
+        self.assertIn("0,50.0", result)
+        self.assertIn("No financial statements found for WWWW.", result)
+
+    def test_get_stock_history_batch_truncates_each_ticker_separately(self):
+        """Every ticker keeps its own section, however many are compared."""
+        from backend import tools
+
+        tickers = ["AAA", "BBB", "CCC", "DDD", "EEE", "FFF"]
+        frames = {ticker: pd.DataFrame({"Close": [1.0] * 10}) for ticker in tickers}
+        with patch.object(tools.CompanyData, "get_ticker_data_batch", return_value=frames), \
+                patch.object(tools, "truncate_tool_output", side_effect=lambda text, max_tokens: text[:40]) as mock_truncate:
+            result = tools.get_stock_history_batch.invoke({"tickers": tickers})
+
+        self.assertEqual(mock_truncate.call_count, len(tickers))
+        for ticker in tickers:
+            self.assertIn(f"=== {ticker} ===", result)
+
+    def test_get_stock_history_batch_downloads_only_uncached_tickers(self):
+        """Tickers already in the history disk cache are not downloaded again, and new ones are cached."""
+        from backend import tools
+
+        cached_frame = pd.DataFrame({"Close": [10.0]})
+        fetched_frame = pd.DataFrame({"Close": [20.0]})
+        self.disk_cache.set("history:AAA:1mo:1d", cached_frame)
+        with patch.object(tools.CompanyData, "get_ticker_data_batch", return_value={"BBB": fetched_frame}) as mock_batch, \
+                patch.object(tools, "truncate_tool_output", side_effect=lambda text, max_tokens: text):
+            result = tools.get_stock_history_batch.invoke({"tickers": ["aaa", "BBB"]})
+
+        mock_batch.assert_called_once_with(["BBB"], period="1mo", interval="1d", limit=10)
+        self.assertIn("=== AAA ===\n,Close\n0,10.0", result)
+        self.assertIn("=== BBB ===\n,Close\n0,20.0", result)
+        pd.testing.assert_frame_equal(self.disk_cache.get("history:BBB:1mo:1d"), fetched_frame)
+
+    def test_correct_period_parameter_rounds_up_without_llm(self):
+        """Numeric periods resolve to the next larger valid period without calling the LLM."""
+        from backend import tools
+
+        cases = {"10 days": "1mo", "2 weeks": "1mo", "1 week": "5d", "18 months": "2y", "20y": "max"}
+        with patch.object(tools, "_get_llm") as mock_get_llm:
+            for period, expected in cases.items():
+                self.assertEqual(tools.correct_period_parameter.invoke({"invalid_period": period}), expected)
+
+        mock_get_llm.assert_not_called()
+
+    def test_correct_period_parameter_llm_fallback_uses_structured_output(self):
+        """Unparseable periods ask the LLM for a PeriodCorrection and return its period field."""
+        from backend import tools
+
+        with patch.object(tools, "_get_llm") as mock_get_llm:
+            structured = mock_get_llm.return_value.with_structured_output.return_value
+            structured.invoke.return_value = tools.PeriodCorrection(period="ytd")
+            self.assertEqual(tools.correct_period_parameter.invoke({"invalid_period": "since january"}), "ytd")
+
+            structured.invoke.side_effect = ValueError("no valid period")
+            self.assertEqual(tools.correct_period_parameter.invoke({"invalid_period": "whenever"}), "1mo")
+
+        mock_get_llm.return_value.with_structured_output.assert_called_with(tools.PeriodCorrection)
+
+    def test_extract_stock_mentions_resolves_companies_in_order(self):
+        """Company names are searched concurrently, skip given tickers and keep their order."""
+        from backend import tools
+
+        mentions = tools.StockMentions(symbols=["AAPL"], companies=["aapl", "Tesla", "Nowhere Inc"])
+        search_results = {
+            "Tesla": {"found": True, "symbol": "TSLA", "name": "Tesla, Inc."},
+            "Nowhere Inc": {"found": False, "error": "No results found"},
+        }
+        with patch.object(tools, "_get_llm") as mock_get_llm, \
+                patch.object(tools, "truncate_tool_output", side_effect=lambda text, max_tokens: text), \
+                patch.object(tools.CompanyData, "search_stock_symbol", side_effect=search_results.get) as mock_search:
+            mock_get_llm.return_value.with_structured_output.return_value.invoke.return_value = mentions
+            result = tools.extract_stock_mentions.invoke({"query": "AAPL vs Tesla vs Nowhere Inc"})
+
+        self.assertEqual([r["symbol"] for r in result["resolved"]], ["AAPL", "TSLA", None])
+        self.assertEqual(mock_search.call_count, 2)
+
+    def test_extract_stock_mentions_skips_llm_for_bare_ticker(self):
+        """A query that is just a ticker resolves directly without the extraction LLM call."""
+        from backend import tools
+
+        with patch.object(tools, "_get_llm") as mock_get_llm, \
+                patch.object(tools.CompanyData, "search_stock_symbol") as mock_search:
+            result = tools.extract_stock_mentions.invoke({"query": " BRK.B "})
+
+        self.assertEqual([r["symbol"] for r in result["resolved"]], ["BRK.B"])
+        mock_get_llm.assert_not_called()
+        mock_search.assert_not_called()
+
+
+class TestSemanticCache(unittest.TestCase):
+    def setUp(self):
+        """Build a cache backed by fake embeddings and a temporary directory."""
+        from backend.semantic_cache import SemanticCache
+
+        self.vectors = {
+            "Is MSFT a buy?": [1.0, 0.0],
+            "Should I buy MSFT?": [0.99, 0.05],
+            "What is TSLA's P/E?": [0.0, 1.0],
+            "What's the P/E of GOOGL?": [0.6, 0.8],
+            "What's the P/E of GOOG?": [0.6, 0.8],
+        }
+        mock_embeddings = MagicMock()
+        mock_embeddings.embed_query.side_effect = lambda q: self.vectors[q]
+        self.cache = SemanticCache(path=os.path.join(tempfile.mkdtemp(), "cache"), embeddings=mock_embeddings)
+
+    def test_lookup_hits_near_duplicate_query(self):
+        """A semantically similar query replays the stored response."""
+        self.cache.add(self.cache.embed("Is MSFT a buy?"), "Is MSFT a buy?", "MSFT looks fairly valued.",
+                       {"cache": "semantic_hit"})
+
+        result = self.cache.lookup(self.cache.embed("Should I buy MSFT?"), "Should I buy MSFT?")
+
+        self.assertIsNotNone(result)
+        self.assertEqual(result[0], "MSFT looks fairly valued.")
+        self.assertEqual(result[1]["cache"], "semantic_hit")
+
+    def test_lookup_misses_unrelated_or_stale_query(self):
+        """Dissimilar queries and expired entries are not replayed."""
+        self.cache.add(self.cache.embed("Is MSFT a buy?"), "Is MSFT a buy?", "MSFT looks fairly valued.", {})
+
+        self.assertIsNone(self.cache.lookup(self.cache.embed("What is TSLA's P/E?"), "What is TSLA's P/E?"))
+
+        self.cache.ttl = -1
+        self.assertIsNone(self.cache.lookup(self.cache.embed("Is MSFT a buy?"), "Is MSFT a buy?"))
+
+    def test_lookup_requires_same_tickers(self):
+        """An identical template about a different ticker is not replayed, however similar."""
+        googl, goog = "What's the P/E of GOOGL?", "What's the P/E of GOOG?"
+        self.cache.add(self.cache.embed(googl), googl, "GOOGL trades at 25x earnings.", {})
+
+        self.assertIsNone(self.cache.lookup(self.cache.embed(goog), goog))
+        self.assertIsNotNone(self.cache.lookup(self.cache.embed(googl), googl))
+
+    def test_default_ttl_matches_price_cache(self):
+        """Cached answers expire as fast as the price data they quote."""
+        from backend.tools import PRICE_CACHE_TTL
+
+        self.assertEqual(self.cache.ttl, PRICE_CACHE_TTL)
+
+
+class TestTrajectoryCache(unittest.TestCase):
+    def setUp(self):
+        """Create a trajectory cache in a temporary directory."""
+        from backend.trajectory_cache import TrajectoryCache
+
+        self.cache = TrajectoryCache(db_path=os.path.join(tempfile.mkdtemp(), "trajectories.db"))
+        self.tool_calls = [{"name": "get_stock_history", "args": {"ticker": "MSFT", "period": "5d"}}]
+
+    def tearDown(self):
+        self.cache.close()
+
+    def test_get_matches_normalized_query(self):
+        """Recorded tool calls are found regardless of case and spacing."""
+        self.cache.put("Show MSFT for the past week", self.tool_calls)
+
+        self.assertEqual(self.cache.get("  show msft for  the past WEEK "), self.tool_calls)
+        self.assertIsNone(self.cache.get("Show AAPL for the past week"))
+
+    def test_is_reusable_requires_tickers_in_query(self):
+        """A trajectory is only replayed when its tickers appear in the query."""
+        tool_names = {"get_stock_history"}
+
+        self.assertTrue(self.cache.is_reusable("Show MSFT for the past week", self.tool_calls, tool_names))
+        self.assertFalse(self.cache.is_reusable("Show it for the past week", self.tool_calls, tool_names))
+        self.assertFalse(self.cache.is_reusable("Show MSFT for the past week", self.tool_calls, set()))
+
+
+class TestLogger(unittest.TestCase):
+    def setUp(self):
+        """Build a Logger whose inserts are recorded instead of sent to MotherDuck."""
+        from backend.database import Logger
+
+        self.logger = Logger(database_name="test", token="dummy")
+        self.batches = []
+        self.logger._write_rows = lambda rows: self.batches.append(len(rows))
+        self.addCleanup(self.logger.close)
+
+    def log(self, n=1):
+        metadata = {"total_tokens": 10, "total_cost_usd": 0.001, "tool_calls": 1, "tools_used": {"get_company_info": 1}}
+        for _ in range(n):
+            self.logger.log_agent_run("query", "response", metadata)
+
+    def test_worker_writes_full_batches_and_flushes_rest_on_close(self):
+        """Rows are inserted batch_size at a time; close() flushes the partial batch."""
+        self.logger.batch_size = 2
+        self.logger.flush_interval = 10
+        self.log(5)
+        self.logger.close()
+
+        self.assertEqual(self.batches, [2, 2, 1])
+
+    def test_worker_flushes_partial_batch_after_interval(self):
+        """A lone row is written once flush_interval elapses, without waiting for close()."""
+        import time
+
+        self.logger.flush_interval = 0.05
+        self.log()
+        deadline = time.monotonic() + 2
+        while not self.batches and time.monotonic() < deadline:
+            time.sleep(0.01)
+
+        self.assertEqual(self.batches, [1])
+
+    def test_log_agent_run_does_not_wait_on_connection_lock(self):
+        """Queueing a row never blocks behind a connect or insert holding the connection lock."""
+        import time
+
+        with self.logger._lock:
+            start = time.monotonic()
+            self.log()
+            self.assertLess(time.monotonic() - start, 0.5)
+
+    def test_write_rows_binds_tools_used_dict_to_map_column(self):
+        """A {tool: count} dict is inserted into the native MAP column as-is."""
+        import duckdb
+
+        from backend.database import Logger
+
+        logger = Logger(database_name="test", token="dummy")
+        logger.conn = duckdb.connect()
+        logger._ensure_table_exists()
+        logger._write_rows([("query", "response", 10, 0.001, 2, {"get_company_info": 2})])
+
+        row = logger.conn.execute("SELECT tools_used FROM agent_logs").fetchone()
+        self.assertEqual(row[0], {"get_company_info": 2})
+
+    def test_ensure_table_exists_migrates_json_tools_used(self):
+        """A legacy JSON tools_used column, including '[]' and NULL rows, is migrated to a MAP."""
+        import duckdb
+
+        from backend.database import Logger
+
+        logger = Logger(database_name="test", token="dummy")
+        logger.conn = duckdb.connect()
+        logger.conn.execute("CREATE TABLE agent_logs (query TEXT, tools_used JSON)")
+        logger.conn.execute("""
+            INSERT INTO agent_logs VALUES ('a', '{"get_stock_history": 3}'), ('b', '[]'), ('c', NULL)
+        """)
+        logger._ensure_table_exists()
+
+        rows = logger.conn.execute("SELECT query, tools_used FROM agent_logs ORDER BY query").fetchall()
+        self.assertEqual(rows, [("a", {"get_stock_history": 3}), ("b", {}), ("c", {})])
+
 
 if __name__ == "__main__":
     unittest.main()